@@ -0,0 +1,224 @@
+import json
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import xscen as xs
+
+
+class TestStackDropNans:
+    def _ds(self):
+        rng = np.random.default_rng(0)
+        ds = xr.Dataset(
+            {
+                "tas": (("time", "lat", "lon"), rng.random((3, 4, 5))),
+                "orog": (("lat", "lon"), rng.integers(0, 100, (4, 5))),
+                "time_bnds": (("time", "bnds"), np.zeros((3, 2))),
+            },
+            coords={
+                "time": [0, 1, 2],
+                "lat": ("lat", [40.0, 41.0, 42.0, 43.0], {"units": "degrees_north"}),
+                "lon": ("lon", [-70.0, -69.0, -68.0, -67.0, -66.0]),
+            },
+        )
+        mask = xr.DataArray(
+            rng.random((4, 5)) > 0.5,
+            dims=("lat", "lon"),
+            coords={"lat": ds.lat, "lon": ds.lon},
+        )
+        return ds, mask
+
+    def test_roundtrip(self, tmp_path):
+        ds, mask = self._ds()
+        out = xs.utils.stack_drop_nans(
+            ds, mask, to_file=str(tmp_path / "coords" / "coords_{shape}.nc")
+        )
+
+        assert out.sizes["loc"] == mask.sum()
+        assert out.lat.attrs == {"units": "degrees_north", "original_shape": "4x5"}
+        assert (tmp_path / "coords" / "coords_4x5.nc").is_file()
+        # Variables without the mask dimensions are not broadcast along the new one
+        assert out.time_bnds.dims == ("time", "bnds")
+        # Integer variables are not cast to float
+        assert out.orog.dtype == ds.orog.dtype
+
+        for coords in [
+            None,
+            ["lat", "lon"],
+            str(tmp_path / "coords" / "coords_{shape}.nc"),
+        ]:
+            back = xs.utils.unstack_fill_nan(out, coords=coords)
+            np.testing.assert_array_equal(
+                back.tas.transpose(*ds.tas.dims), ds.tas.where(mask)
+            )
+
+    @pytest.mark.parametrize(
+        "reorder",
+        [
+            lambda m: m.isel(lat=slice(None, None, -1)),
+            lambda m: m.transpose("lon", "lat"),
+            lambda m: m.isel(lon=slice(1, 4)),
+            lambda m: m.reindex(lat=[39.0, 40.0, 41.0, 42.0, 43.0], fill_value=True),
+        ],
+        ids=["reversed", "transposed", "smaller", "larger"],
+    )
+    def test_misaligned_mask(self, reorder):
+        ds, mask = self._ds()
+        out = xs.utils.stack_drop_nans(ds, reorder(mask))
+
+        # Each value is kept with its own labels
+        expected = ds.tas.sel(lat=out.lat, lon=out.lon)
+        np.testing.assert_array_equal(out.tas, expected)
+        assert mask.sel(lat=out.lat, lon=out.lon).all()
+        assert out.sizes["loc"] == reorder(mask).reindex_like(mask).sum()
+
+
+class TestCV:
+    def test_regex_first_match(self):
+        # "Q.*" comes before "2Q.*", but doesn't fullmatch "2QS-DEC"
+        assert xs.utils.CV.xrfreq_to_frequency("QS-DEC") == "qtr"
+        assert xs.utils.CV.xrfreq_to_frequency("2QS-DEC") == "6mon"
+        assert xs.utils.CV.xrfreq_to_frequency("MS") == "mon"
+        assert xs.utils.CV.xrfreq_to_frequency("X", default="pass") == "X"
+        with pytest.raises(KeyError):
+            xs.utils.CV.xrfreq_to_frequency("X")
+
+    @pytest.mark.parametrize(
+        "key,match",
+        [("(A)S.*", "can.t contain capturing"), ("(?i)A.*", "can.t set global flags")],
+    )
+    def test_regex_invalid_keys(self, tmp_path, monkeypatch, key, match):
+        (tmp_path / "bad_cv.json").write_text(
+            json.dumps({"is_regex": True, "ABC": "abc", key: "a"})
+        )
+        monkeypatch.setattr(xs.utils, "_CV_DIR", tmp_path)
+        with pytest.raises(ValueError, match=match):
+            xs.utils.CV.bad_cv
+
+    def test_regex_scoped_flags(self, tmp_path, monkeypatch):
+        (tmp_path / "scoped_cv.json").write_text(
+            json.dumps({"is_regex": True, "ABC": "abc", "(?i:d)EF": "def"})
+        )
+        monkeypatch.setattr(xs.utils, "_CV_DIR", tmp_path)
+        monkeypatch.delitem(xs.utils.CV.__dict__, "scoped_cv", raising=False)
+        assert xs.utils.CV.scoped_cv("dEF") == "def"
+        # The scoped flag doesn't leak to the other keys
+        assert xs.utils.CV.scoped_cv("abc", default=None) is None
+
+
+class TestCleanUp:
+    def _ds(self):
+        time = xr.cftime_range("2000-01-01", periods=730, freq="D", calendar="noleap")
+        tas = np.random.default_rng(0).random((730, 3))
+        ds = xr.Dataset(
+            {"tas": (("time", "lat"), tas, {"units": "K"})},
+            coords={"time": time, "lat": [10.0, 20.0, 30.0]},
+        )
+        # A point that is always null, like an ocean grid cell
+        ds["tas"] = ds.tas.where(ds.lat != 20)
+        return ds
+
+    @pytest.mark.parametrize("chunks", [None, {"time": 365}])
+    def test_convert_calendar(self, chunks):
+        ds = self._ds()
+        if chunks is not None:
+            ds = ds.chunk(chunks)
+
+        out = xs.utils.clean_up(
+            ds,
+            convert_calendar_kwargs={"target": "standard", "align_on": "date"},
+            missing_by_var={"tas": 0},
+        )
+        out = out.compute()
+
+        assert out.time.dt.calendar == "standard"
+        # The always-null point stays null, the others are filled on the added leap day
+        assert out.tas.sel(lat=20).isnull().all()
+        assert out.tas.sel(lat=[10, 30]).notnull().all()
+        assert (out.tas.sel(time="2000-02-29", lat=[10, 30]) == 0).all()
+        assert out.tas.attrs["units"] == "K"
+
+    @pytest.mark.parametrize(
+        "attrs",
+        [
+            {"cat:id": "new", "xs:id": "old", "title": "t"},
+            {"xs:id": "old", "cat:id": "new", "title": "t"},
+        ],
+    )
+    def test_change_attr_prefix(self, attrs):
+        ds = self._ds()
+        ds.attrs = attrs
+        out = xs.utils.clean_up(ds, change_attr_prefix="xs:")
+        assert out.attrs == {"xs:id": "new", "title": "t"}
+
+    @pytest.mark.parametrize(
+        "patterns,matched",
+        [
+            (["units"], {"units"}),
+            (["^cell"], {"cell_methods", "cell_measures"}),
+            (["ist*"], {"history", "history_extra"}),
+            (
+                ["units", "^cell", "ist*"],
+                {"units", "cell_methods", "cell_measures", "history", "history_extra"},
+            ),
+            ("units", {"units"}),
+            ("^cell", {"cell_methods", "cell_measures"}),
+        ],
+        ids=["exact", "prefix", "contains", "all", "str", "str-prefix"],
+    )
+    def test_attrs_patterns(self, patterns, matched):
+        ds = self._ds()
+        attrs = {
+            "units": "K",
+            "cell_methods": "time: mean",
+            "cell_measures": "area: areacella",
+            "history": "a",
+            "history_extra": "b",
+            "long_name": "temperature",
+        }
+        ds.tas.attrs = attrs
+        ds.attrs = attrs
+
+        out = xs.utils.clean_up(
+            ds.copy(deep=True), attrs_to_remove={"tas": patterns, "global": patterns}
+        )
+        assert set(out.tas.attrs) == set(attrs) - matched
+        assert set(out.attrs) == set(attrs) - matched
+
+        out = xs.utils.clean_up(
+            ds.copy(deep=True),
+            remove_all_attrs_except={"tas": patterns, "global": patterns},
+        )
+        assert set(out.tas.attrs) == matched
+        assert set(out.attrs) == matched
+
+
+class TestUnstackDates:
+    @pytest.mark.parametrize("start", ["2000-01-01", "2000-03-01"])
+    def test_dtypes(self, start):
+        # Starting in January gives full years that are not padded, March ones are
+        time = xr.date_range(start, periods=24, freq="MS")
+        ds = xr.Dataset(
+            {
+                "tas": ("time", np.arange(24, dtype=np.float32)),
+                "n": ("time", np.arange(24), {"units": "1"}),
+                "flag": ("time", np.arange(24) % 2 == 0),
+                "orog": ((), 100),
+            },
+            coords={"time": time},
+        )
+        out = xs.utils.unstack_dates(ds)
+
+        assert out.tas.dtype == np.float32
+        assert out.n.dtype == np.float64
+        assert out.flag.dtype == object
+        assert out.orog.dtype == ds.orog.dtype
+        assert out.n.attrs == {"units": "1"}
+        assert out.season.values.tolist()[:3] == ["JAN", "FEB", "MAR"]
+        np.testing.assert_array_equal(
+            out.n.stack(t=["time", "season"]).dropna("t"), ds["n"]
+        )
+
+        da = xs.utils.unstack_dates(ds["n"])
+        assert da.dtype == np.float64
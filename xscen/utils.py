@@ -4,6 +4,8 @@ import logging
 import os
 import re
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import StringIO
 from itertools import chain
 from pathlib import Path
@@ -14,6 +16,7 @@ import flox.xarray
 import numpy as np
 import pandas as pd
 import xarray as xr
+from xarray.core import dtypes
 from xclim.core import units
 from xclim.core.calendar import convert_calendar, get_calendar, parse_offset
 from xclim.core.utils import uses_dask
@@ -39,6 +42,36 @@ __all__ = [
 ]
 
 
+# Number of days in a year, for the calendars where it is constant.
+_DAYS_PER_YEAR = {
+    "noleap": 365,
+    "365_day": 365,
+    "360_day": 360,
+    "all_leap": 366,
+    "366_day": 366,
+}
+
+_NATURAL_SORT_RE = re.compile("([0-9]+)")
+_DEFAULT_RE_FLAGS = re.compile("").flags
+
+# Patterns and link templates used by `publish_release_notes`
+_HYPERLINK_RE = re.compile(r":(issue|pull|user):`([a-zA-Z0-9_.-]+)`")
+_TITLE_RE = re.compile(r"\n(.*?)\n(-+|\^+)")
+_RST_LINK_RE = re.compile(r"`([\w\s]+)\s<(.+?)>`_")
+_RELEASE_NOTES_LINKS = {
+    "rst": {
+        "issue": "`GH/{0} <https://github.com/Ouranosinc/xscen/issues/{0}>`_",
+        "pull": "`PR/{0} <https://github.com/Ouranosinc/xscen/pull/{0}>`_",
+        "user": "`@{0} <https://github.com/{0}>`_",
+    },
+    "md": {
+        "issue": "[GH/{0}](https://github.com/Ouranosinc/xscen/issues/{0})",
+        "pull": "[PR/{0}](https://github.com/Ouranosinc/xscen/pull/{0})",
+        "user": "[@{0}](https://github.com/{0})",
+    },
+}
+
+
 def minimum_calendar(*calendars) -> str:
     """Return the minimum calendar from a list.
 
@@ -63,18 +96,20 @@ def translate_time_chunk(chunks: dict, calendar: str, timesize) -> dict:
     -1 translates to `timesize`
     'Nyear' translates to N times the number of days in a year of calendar `calendar`.
     """
-    for k, v in chunks.items():
-        if isinstance(v, dict):
-            chunks[k] = translate_time_chunk(v.copy(), calendar, timesize)
-        elif k == "time" and v is not None:
-            if isinstance(v, str) and v.endswith("year"):
-                n = int(chunks["time"].split("year")[0])
-                Nt = n * {"noleap": 365, "360_day": 360, "all_leap": 366}.get(
-                    calendar, 365.25
-                )
-                chunks[k] = int(Nt)
-            elif v == -1:
-                chunks[k] = timesize
+    stack = [chunks]
+    while stack:
+        d = stack.pop()
+        for k, v in d.items():
+            if isinstance(v, dict):
+                # Nested specs are copied so the caller's dicts are left untouched.
+                d[k] = v.copy()
+                stack.append(d[k])
+            elif k == "time" and v is not None:
+                if isinstance(v, str) and v.endswith("year"):
+                    n = int(v[:-4])
+                    d[k] = int(n * _DAYS_PER_YEAR.get(calendar, 365.25))
+                elif v == -1:
+                    d[k] = timesize
     return chunks
 
 
@@ -123,32 +158,39 @@ def stack_drop_nans(
     """
     original_shape = "x".join(map(str, mask.shape))
 
-    mask_1d = mask.stack({new_dim: mask.dims})
-    out = ds.stack({new_dim: mask.dims}).where(mask_1d, drop=True).reset_index(new_dim)
-    for dim in mask.dims:
-        out[dim].attrs.update(ds[dim].attrs)
+    # Align on the labels first, so that positions in the mask are also positions in ds.
+    ds_aligned, mask_aligned = xr.align(ds, mask, join="inner")
+
+    # Positions of the points to keep, one integer array per dimension of the mask.
+    # Indexing those directly avoids building the full stacked dataset before dropping.
+    mask_vals = np.asarray(mask_aligned.values)
+    indexes = np.unravel_index(np.flatnonzero(mask_vals), mask_vals.shape)
+    out = ds_aligned.isel(
+        {
+            dim: xr.DataArray(idx, dims=(new_dim,))
+            for dim, idx in zip(mask_aligned.dims, indexes)
+        }
+    )
+    # carry information about original shape to be able to unstack properly
+    out = out.assign_coords(
+        {
+            dim: (
+                new_dim,
+                mask_aligned[dim].values[idx],
+                {**ds[dim].attrs, "original_shape": original_shape},
+            )
+            for dim, idx in zip(mask_aligned.dims, indexes)
+        }
+    ).transpose(..., new_dim)
 
     if to_file is not None:
         # set default path to store the information necessary to unstack
         # the name includes the domain and the original shape to uniquely identify the dataset
         domain = ds.attrs.get("cat:domain", "unknown")
         to_file = to_file.format(domain=domain, shape=original_shape)
-        if not Path(to_file).parent.exists():
-            os.makedirs(Path(to_file).parent, exist_ok=True)
+        Path(to_file).parent.mkdir(parents=True, exist_ok=True)
         mask.coords.to_dataset().to_netcdf(to_file)
 
-    # carry information about original shape to be able to unstack properly
-    for dim in mask.dims:
-        out[dim].attrs["original_shape"] = original_shape
-
-        # this is needed to fix a bug in xarray '2022.6.0'
-        out[dim] = xr.DataArray(
-            out[dim].values,
-            dims=out[dim].dims,
-            coords=out[dim].coords,
-            attrs=out[dim].attrs,
-        )
-
     return out
 
 
@@ -263,11 +305,15 @@ def natural_sort(_list: list):
 
     e.g. [r3i1p1, r1i1p1, r10i1p1] is sorted as [r1i1p1, r3i1p1, r10i1p1] instead of [r10i1p1, r1i1p1, r3i1p1]
     """
-    convert = lambda text: int(text) if text.isdigit() else text.lower()  # noqa: E731
-    alphanum_key = lambda key: [  # noqa: E731
-        convert(c) for c in re.split("([0-9]+)", key)
-    ]
-    return sorted(_list, key=alphanum_key)
+
+    def _alphanum_key(key):
+        parts = _NATURAL_SORT_RE.split(key)
+        # With a capturing group, the numeric parts are always at odd indexes
+        parts[1::2] = [int(c) for c in parts[1::2]]
+        parts[0::2] = [c.lower() for c in parts[0::2]]
+        return parts
+
+    return sorted(_list, key=_alphanum_key)
 
 
 def get_cat_attrs(ds: Union[xr.Dataset, dict], prefix: str = "cat:") -> dict:
@@ -290,7 +336,8 @@ def get_cat_attrs(ds: Union[xr.Dataset, dict], prefix: str = "cat:") -> dict:
         attrs = ds.attrs
     else:
         attrs = ds
-    return {k[len(prefix) :]: v for k, v in attrs.items() if k.startswith(f"{prefix}")}
+    n = len(prefix)
+    return {k[n:]: v for k, v in attrs.items() if k.startswith(prefix)}
 
 
 @parse_config
@@ -319,7 +366,8 @@ CV = ModuleType(
         Json files must be shallow dictionaries to be supported. If the json file
         contains a ``is_regex: True`` entry, then the keys are automatically
         translated as regex patterns and the function returns the value of the first
-        key that matches the pattern. Otherwise the function essentially acts like a
+        key that matches the pattern. Those keys can't contain capturing groups nor
+        inline global flags. Otherwise the function essentially acts like a
         normal dictionary. The 'raw' data parsed from the json file is added in the
         ``dict`` attribute of the function.
         Example:
@@ -382,14 +430,37 @@ def __read_CVs(cvfile):
       - another value, that value is returned.
 """
 
+    if is_regex:
+        # All patterns are merged in a single alternation, each in its own named group.
+        # Alternatives are tried in order, so the first matching key still wins.
+        # This constrains the keys:
+        # - no capturing groups, since the merge shifts their numbers (and backreferences).
+        #   Non-capturing groups "(?:...)" are fine.
+        # - no inline global flags like "(?i)". Python 3.11+ refuses them inside the merged
+        #   pattern and older versions apply them to all keys. Scoped flags "(?i:...)" are fine.
+        for cin in cv:
+            pattern = re.compile(cin)
+            if pattern.groups:
+                raise ValueError(
+                    f"Regex keys can't contain capturing groups, use '(?:...)' instead. Got '{cin}'."
+                )
+            if pattern.flags != _DEFAULT_RE_FLAGS:
+                raise ValueError(
+                    f"Regex keys can't set global flags, use scoped flags like '(?i:...)' instead. Got '{cin}'."
+                )
+        cv_regex = re.compile(
+            "|".join(f"(?P<_cv{i}>{cin})" for i, cin in enumerate(cv.keys()))
+        )
+        cv_outs = list(cv.values())
+
     def cvfunc(key, default="error"):
         if is_regex:
-            for cin, cout in cv.items():
-                try:
-                    if re.fullmatch(cin, key):
-                        return cout
-                except TypeError:
-                    pass
+            try:
+                match = cv_regex.fullmatch(key)
+            except TypeError:
+                match = None
+            if match is not None:
+                return cv_outs[int(match.lastgroup[3:])]
         else:
             if key in cv:
                 return cv[key]
@@ -410,11 +481,42 @@ def __read_CVs(cvfile):
     return cvfunc
 
 
-for cvfile in (Path(__file__).parent / "CVs").glob("*.json"):
+_CV_DIR = Path(__file__).parent / "CVs"
+
+
+def _cv_getattr(name):
+    # The json files are only read the first time their mapping is accessed.
+    cvfile = _CV_DIR / f"{name}.json"
+    if not cvfile.is_file():
+        raise AttributeError(f"module 'CV' has no attribute '{name}'")
     try:
-        CV.__dict__[cvfile.stem] = __read_CVs(cvfile)
+        cvfunc = __read_CVs(cvfile)
     except Exception as err:
         raise ValueError(f"While reading {cvfile} got {err}")
+    # Cache it in the module, later accesses won't go through __getattr__ anymore.
+    CV.__dict__[name] = cvfunc
+    return cvfunc
+
+
+def _cv_dir():
+    return sorted(set(CV.__dict__) | {cvfile.stem for cvfile in _CV_DIR.glob("*.json")})
+
+
+CV.__getattr__ = _cv_getattr
+CV.__dir__ = _cv_dir
+
+
+@lru_cache(maxsize=256)
+def _units2pint(unit: str, units_metadata: Optional[str] = None):
+    """Cached version of :py:func:`xclim.core.units.units2pint`.
+
+    The units and their metadata are given as strings, so they can be hashed, and then passed
+    to xclim through the attributes of a DataArray, as those of the original variable would be.
+    """
+    attrs = {"units": unit}
+    if units_metadata is not None:
+        attrs["units_metadata"] = units_metadata
+    return units.units2pint(xr.DataArray(np.nan, attrs=attrs))
 
 
 def change_units(ds: xr.Dataset, variables_and_units: dict) -> xr.Dataset:
@@ -437,13 +539,15 @@ def change_units(ds: xr.Dataset, variables_and_units: dict) -> xr.Dataset:
     """
     with xr.set_options(keep_attrs=True):
         for v in variables_and_units:
-            if (v in ds) and (
-                units.units2pint(ds[v]) != units.units2pint(variables_and_units[v])
-            ):
-                time_in_ds = units.units2pint(ds[v]).dimensionality.get("[time]")
-                time_in_out = units.units2pint(
-                    variables_and_units[v]
-                ).dimensionality.get("[time]")
+            if v not in ds:
+                continue
+            units_in_ds = _units2pint(
+                ds[v].attrs["units"], ds[v].attrs.get("units_metadata")
+            )
+            units_in_out = _units2pint(variables_and_units[v])
+            if units_in_ds != units_in_out:
+                time_in_ds = units_in_ds.dimensionality.get("[time]", 0)
+                time_in_out = units_in_out.dimensionality.get("[time]", 0)
 
                 if time_in_ds == time_in_out:
                     ds[v] = units.convert_units_to(ds[v], variables_and_units[v])
@@ -461,6 +565,24 @@ def change_units(ds: xr.Dataset, variables_and_units: dict) -> xr.Dataset:
     return ds
 
 
+def _all_null(da: xr.DataArray) -> xr.DataArray:
+    """Return True where `da` is null at all time steps.
+
+    For float data, the null test and the reduction over time are done in a single kernel,
+    which also works blockwise on dask arrays chunked along time.
+    """
+    if "time" not in da.dims:
+        return da.isnull()
+    if da.dtype.kind not in "fc":
+        return da.isnull().all("time")
+    return xr.apply_ufunc(
+        lambda arr: np.isnan(arr).all(axis=-1),
+        da,
+        input_core_dims=[["time"]],
+        dask="allowed",
+    )
+
+
 def clean_up(
     ds: xr.Dataset,
     *,
@@ -555,9 +677,8 @@ def clean_up(
 
     # convert calendar
     if convert_calendar_kwargs:
-        ds_copy = ds.copy()
         # create mask of grid point that should always be nan
-        ocean = ds_copy.isnull().all("time")
+        ocean = xr.Dataset({v: _all_null(ds[v]) for v in ds.data_vars})
 
         # if missing_by_var exist make sure missing data are added to time axis
         if missing_by_var:
@@ -580,14 +701,15 @@ def clean_up(
             del convert_calendar_kwargs["missing"]
             for var, missing in missing_by_var.items():
                 logging.info(f"Filling missing {var} with {missing}")
+                # DataArray.where keeps the attributes, unlike xr.where
                 if missing == "interpolate":
-                    ds_with_nan = ds[var].where(ds[var] != -9999)
-                    converted_var = ds_with_nan.interpolate_na("time", method="linear")
+                    ds[var] = (
+                        ds[var]
+                        .where(ds[var] != -9999)
+                        .interpolate_na("time", method="linear")
+                    )
                 else:
-                    var_attrs = ds[var].attrs
-                    converted_var = xr.where(ds[var] == -9999, missing, ds[var])
-                    converted_var.attrs = var_attrs
-                ds[var] = converted_var
+                    ds[var] = ds[var].where(ds[var] != -9999, missing)
 
     # unstack nans
     if maybe_unstack_dict:
@@ -597,13 +719,28 @@ def clean_up(
         for var, n in round_var.items():
             ds[var] = ds[var].round(n)
 
-    def _search(a, b):
-        if a[-1] == "*":  # check if a is contained in b
-            return a[:-1] in b
-        elif a[0] == "^":
-            return b.startswith(a[1:])
-        else:
-            return a == b
+    def _matcher(patterns):
+        # Sort the patterns by type of matching once, instead of for every attribute
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        exact, prefixes, contains = set(), [], []
+        for p in patterns:
+            if p[-1] == "*":  # check if p is contained in the attr
+                contains.append(p[:-1])
+            elif p[0] == "^":  # check if the attr starts with p
+                prefixes.append(p[1:])
+            else:
+                exact.add(p)
+        prefixes = tuple(prefixes)
+
+        def _match(attr):
+            return (
+                attr in exact
+                or attr.startswith(prefixes)
+                or any(c in attr for c in contains)
+            )
+
+        return _match
 
     if common_attrs_only:
         from .catalog import generate_id
@@ -612,13 +749,20 @@ def clean_up(
         if isinstance(common_attrs_only, dict):
             common_attrs_only = list(common_attrs_only.values())
 
-        for i in range(len(common_attrs_only)):
-            if isinstance(common_attrs_only[i], (str, Path)):
-                dataset = xr.open_dataset(
-                    common_attrs_only[i], **common_attrs_open_kwargs
-                )
-            else:
-                dataset = common_attrs_only[i]
+        def _open(dataset):
+            if isinstance(dataset, (str, Path)):
+                return xr.open_dataset(dataset, **common_attrs_open_kwargs)
+            return dataset
+
+        # Opening files is mostly waiting on I/O, so the paths are opened concurrently
+        n_paths = sum(isinstance(x, (str, Path)) for x in common_attrs_only)
+        if n_paths > 1:
+            with ThreadPoolExecutor(max_workers=min(16, n_paths)) as executor:
+                datasets = list(executor.map(_open, common_attrs_only))
+        else:
+            datasets = [_open(x) for x in common_attrs_only]
+
+        for dataset in datasets:
             attributes = ds.attrs.copy()
             for a_key, a_val in attributes.items():
                 if (
@@ -638,23 +782,23 @@ def clean_up(
     if attrs_to_remove:
         for var, list_of_attrs in attrs_to_remove.items():
             obj = ds if var == "global" else ds[var]
-            for ds_attr in list(obj.attrs.keys()):  # iter over attrs in ds
-                for list_attr in list_of_attrs:  # check if we want to remove attrs
-                    if _search(list_attr, ds_attr):
-                        del obj.attrs[ds_attr]
+            if not obj.attrs:
+                continue
+            match = _matcher(list_of_attrs)
+            for ds_attr in tuple(obj.attrs):  # iter over attrs in ds
+                if match(ds_attr):  # check if we want to remove attrs
+                    del obj.attrs[ds_attr]
 
     # delete all attrs, but the ones in the list
     if remove_all_attrs_except:
         for var, list_of_attrs in remove_all_attrs_except.items():
             obj = ds if var == "global" else ds[var]
-            for ds_attr in list(obj.attrs.keys()):  # iter over attrs in ds
-                delete = True  # assume we should delete it
-                for list_attr in list_of_attrs:
-                    if _search(list_attr, ds_attr):
-                        delete = (
-                            False  # if attr is on the list to not delete, don't delete
-                        )
-                if delete:
+            if not obj.attrs:
+                continue
+            match = _matcher(list_of_attrs)
+            for ds_attr in tuple(obj.attrs):  # iter over attrs in ds
+                # if attr is on the list to not delete, don't delete
+                if not match(ds_attr):
                     del obj.attrs[ds_attr]
 
     if add_attrs:
@@ -664,10 +808,16 @@ def clean_up(
                 obj.attrs[attrname] = attrtmpl
 
     if change_attr_prefix:
-        for ds_attr in list(ds.attrs.keys()):
-            new_name = ds_attr.replace("cat:", change_attr_prefix)
-            if new_name:
-                ds.attrs[new_name] = ds.attrs.pop(ds_attr)
+        renamed = {
+            k: k.replace("cat:", change_attr_prefix) for k in ds.attrs if "cat:" in k
+        }
+        # On a collision, the renamed attribute wins over the one already using the new prefix.
+        overwritten = set(renamed.values())
+        ds.attrs = {
+            renamed.get(k, k): v
+            for k, v in ds.attrs.items()
+            if k in renamed or k not in overwritten
+        }
 
     return ds
 
@@ -701,44 +851,18 @@ def publish_release_notes(
     with open(history_file) as hf:
         history = hf.read()
 
-    if style == "rst":
-        hyperlink_replacements = {
-            r":issue:`([0-9]+)`": r"`GH/\1 <https://github.com/Ouranosinc/xscen/issues/\1>`_",
-            r":pull:`([0-9]+)`": r"`PR/\1 <https://github.com/Ouranosinc/xscen/pull/\>`_",
-            r":user:`([a-zA-Z0-9_.-]+)`": r"`@\1 <https://github.com/\1>`_",
-        }
-    elif style == "md":
-        hyperlink_replacements = {
-            r":issue:`([0-9]+)`": r"[GH/\1](https://github.com/Ouranosinc/xscen/issues/\1)",
-            r":pull:`([0-9]+)`": r"[PR/\1](https://github.com/Ouranosinc/xscen/pull/\1)",
-            r":user:`([a-zA-Z0-9_.-]+)`": r"[@\1](https://github.com/\1)",
-        }
-    else:
+    if style not in _RELEASE_NOTES_LINKS:
         raise NotImplementedError()
 
-    for search, replacement in hyperlink_replacements.items():
-        history = re.sub(search, replacement, history)
+    links = _RELEASE_NOTES_LINKS[style]
+    history = _HYPERLINK_RE.sub(lambda m: links[m[1]].format(m[2]), history)
 
     if style == "md":
         history = history.replace("=======\nHistory\n=======", "# History")
-
-        titles = {r"\n(.*?)\n([\-]{1,})": "-", r"\n(.*?)\n([\^]{1,})": "^"}
-        for title_expression, level in titles.items():
-            found = re.findall(title_expression, history)
-            for grouping in found:
-                fixed_grouping = (
-                    str(grouping[0]).replace("(", r"\(").replace(")", r"\)")
-                )
-                search = rf"({fixed_grouping})\n([\{level}]{'{' + str(len(grouping[1])) + '}'})"
-                replacement = f"{'##' if level=='-' else '###'} {grouping[0]}"
-                history = re.sub(search, replacement, history)
-
-        link_expressions = r"[\`]{1}([\w\s]+)\s<(.+)>`\_"
-        found = re.findall(link_expressions, history)
-        for grouping in found:
-            search = rf"`{grouping[0]} <.+>`\_"
-            replacement = f"[{str(grouping[0]).strip()}]({grouping[1]})"
-            history = re.sub(search, replacement, history)
+        history = _TITLE_RE.sub(
+            lambda m: f"\n{'##' if m[2][0] == '-' else '###'} {m[1]}", history
+        )
+        history = _RST_LINK_RE.sub(lambda m: f"[{m[1].strip()}]({m[2]})", history)
 
     if not file:
         return history
@@ -825,6 +949,20 @@ def unstack_dates(
             f"Only periods that divide the year evenly are supported. Got {freq}."
         )
 
+    # Years and months of each timestamp, extracted in a single pass over the time axis
+    times = ds.time.values
+    if use_cftime:
+        year_vals, month_vals = (
+            np.array([(t.year, t.month) for t in times], dtype=np.int64)
+            .reshape(-1, 2)
+            .T
+        )
+    else:
+        year_vals = times.astype("datetime64[Y]").astype(np.int64) + 1970
+        month_vals = times.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    years_of_time = xr.DataArray(year_vals, dims=("time",), coords={"time": ds.time})
+    months_of_time = xr.DataArray(month_vals, dims=("time",), coords={"time": ds.time})
+
     # Guess the new season coordinate
     if seasons is None:
         if base == "Q" or (base == "M" and mult > 1):
@@ -833,7 +971,7 @@ def unstack_dates(
             n = mult * {"M": 1, "Q": 3}[base]
             seasons = {
                 m: "".join(months[np.array(range(m - 1, m + n - 1)) % 12])
-                for m in np.unique(ds.time.dt.month)
+                for m in np.unique(months_of_time)
             }
         else:  # M or MS
             seasons = xr.coding.cftime_offsets._MONTH_ABBREVIATIONS
@@ -847,18 +985,33 @@ def unstack_dates(
         # Put it back in the beginning
         seas_list = [seasons[winter_month]] + seas_list[:-1]
         # The year associated with each timestamp (add 1 in winter)
-        years = ds.time.dt.year + xr.where(ds.time.dt.month == winter_month, 1, 0)
+        years = years_of_time + (months_of_time == winter_month)
     else:  # Monthly or aligned seasons
-        years = ds.time.dt.year
+        years = years_of_time
 
     # The goal here is to use `reshape()` instead of `unstack` to limit the number of dask operations.
     # Thus, the time axis must be properly constructed so that reshapes fits the final size.
     # We pad on both sides to ensure full years
     pad_left = seas_list.index(seasons[first.month])
     pad_right = len(seas_list) - (seas_list.index(seasons[last.month]) + 1)
-    dsp = ds.pad(time=(pad_left, pad_right))  # pad with NaN
-    # Similarly pad our "group labels".
-    years = years.pad(time=(pad_left, pad_right), constant_values=(years[0], years[-1]))
+    if pad_left or pad_right:
+        dsp = ds.pad(time=(pad_left, pad_right))  # pad with NaN
+        # Similarly pad our "group labels".
+        years = years.pad(
+            time=(pad_left, pad_right), constant_values=(years[0], years[-1])
+        )
+    else:
+        # Already a complete years x seasons grid, the reshape can be done directly.
+        # Still promote the dtypes as `pad` would, so the output doesn't depend on the first and last months.
+        def promote_da(da):
+            if "time" not in da.dims:
+                return da
+            return da.astype(dtypes.maybe_promote(da.dtype)[0], copy=False)
+
+        if isinstance(ds, xr.Dataset):
+            dsp = ds.map(promote_da, keep_attrs=True)
+        else:
+            dsp = promote_da(ds)
 
     # New coords
     new_time = xr.date_range(  # New time axis (YS)